@@ -1,14 +1,21 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, session
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Subject, Chapter, Quiz, Question, Score
+from models import db, User, Subject, Chapter, Quiz, Question, Score, ChapterMastery, Recommendation
+from recommendations import refresh_recommendations, rebuild_recommendations, forget_quiz, forget_chapters, users_in_subject
+from passwords import DEFAULTS as PASSWORD_HASH_DEFAULTS, PasswordHasherBusy, benchmark
+from sqlalchemy.orm import contains_eager
 from datetime import datetime
 from functools import wraps
+import click
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///quiz_app.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Password hashing settings (method, pool size, queue limit, timeout); see passwords.DEFAULTS
+for key, value in PASSWORD_HASH_DEFAULTS.items():
+    app.config.setdefault(key, value)
 
 db.init_app(app)
 
@@ -27,8 +34,30 @@ def create_admin_user():
 
 with app.app_context():
     db.create_all()
+    # create_all() does not add new indexes to tables that already exist
+    for index in Score.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
     create_admin_user()
 
+@app.cli.command('refresh-recommendations')
+@click.option('--full', is_flag=True, help='Rebuild from all scores instead of only new ones.')
+def refresh_recommendations_command(full):
+    """Recompute practice recommendations (intended to run nightly)."""
+    updated = refresh_recommendations(full=full)
+    click.echo(f"Updated recommendations for {updated} user(s).")
+
+@app.cli.command('bench-password-hash')
+@click.option('--seconds', default=5.0, show_default=True, help='How long to hash for.')
+@click.option('--method', default=None, help='werkzeug hash method to test (defaults to PASSWORD_HASH_METHOD).')
+@click.option('--workers', default=None, type=int, help='Threads to hash on (defaults to PASSWORD_HASH_WORKERS).')
+def bench_password_hash_command(seconds, method, workers):
+    """Report password hashes per second per core for sizing the hash cost."""
+    method = method or app.config['PASSWORD_HASH_METHOD']
+    workers = workers or app.config['PASSWORD_HASH_WORKERS']
+    total, cores, per_core = benchmark(seconds=seconds, method=method, workers=workers)
+    click.echo(f"{method}: {total} hashes on {workers} worker(s) across {cores} core(s) in {seconds:g}s")
+    click.echo(f"{per_core:.1f} hashes/sec per core")
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -83,9 +112,14 @@ def login():
                 return render_template('login.html')
             
             # If we get here, both email and password are correct
+            # Commit in case check_password upgraded the stored hash
+            db.session.commit()
             session['user_id'] = user.id
             return redirect(url_for('dashboard'))
 
+        except PasswordHasherBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login.html')
         except Exception as e:
             app.logger.error(f"Login error: {str(e)}")
             flash('An error occurred. Please try again.', 'error')
@@ -118,7 +152,11 @@ def register():
             qualification=qualification,
             dob=datetime.strptime(dob, '%Y-%m-%d').date() if dob else None
         )
-        new_user.set_password(password)
+        try:
+            new_user.set_password(password)
+        except PasswordHasherBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('register.html')
 
         db.session.add(new_user)
         db.session.commit()
@@ -150,12 +188,19 @@ def dashboard():
                              is_admin=True)
     else:
         past_scores = Score.query.filter_by(user_id=user.id).order_by(Score.timestamp.desc()).all()
+        recommendations = (Recommendation.query
+                           .join(Recommendation.quiz)
+                           .options(contains_eager(Recommendation.quiz).joinedload(Quiz.chapter))
+                           .filter(Recommendation.user_id == user.id)
+                           .order_by(Recommendation.rank)
+                           .all())
         return render_template('dashboard.html', 
                              current_user=user, 
                              subjects=subjects,
                              chapters=chapters,
                              available_quizzes=available_quizzes, 
                              past_scores=past_scores,
+                             recommendations=recommendations,
                              is_admin=False)
 
 @app.route('/logout')
@@ -223,8 +268,10 @@ def delete_user(id):
         return redirect(url_for('manage_users'))
     
     try:
-        # Delete associated scores first
+        # Delete associated scores and recommendation data first
         Score.query.filter_by(user_id=user.id).delete()
+        ChapterMastery.query.filter_by(user_id=user.id).delete()
+        Recommendation.query.filter_by(user_id=user.id).delete()
         db.session.delete(user)
         db.session.commit()
         flash('User and associated data deleted successfully!', 'success')
@@ -394,10 +441,15 @@ def edit_subject(id):
 @admin_required
 def delete_subject(id):
     subject = Subject.query.get_or_404(id)
+    # Drop recommendation data tied to the subject's chapters
+    chapter_ids = [chapter.id for chapter in subject.chapters]
+    affected_users = forget_chapters(chapter_ids)
     # First delete all chapters associated with this subject
     Chapter.query.filter_by(subject_id=id).delete()
     # Then delete the subject
     db.session.delete(subject)
+    db.session.flush()
+    rebuild_recommendations(affected_users)
     db.session.commit()
     flash('Subject deleted successfully!', 'success')
     return redirect(url_for('manage_subjects'))
@@ -461,11 +513,16 @@ def delete_chapter(id):
         chapter = Chapter.query.get_or_404(id)
         subject_id = chapter.subject_id
         
+        # Drop recommendation data tied to this chapter and its quizzes
+        affected_users = forget_chapters([id])
+        
         # First delete all quizzes associated with this chapter
         Quiz.query.filter_by(chapter_id=id).delete()
         
         # Then delete the chapter
         db.session.delete(chapter)
+        db.session.flush()
+        rebuild_recommendations(affected_users)
         db.session.commit()
         flash('Chapter deleted successfully!', 'success')
         return redirect(url_for('manage_chapters', subject_id=subject_id))
@@ -498,6 +555,9 @@ def add_quiz():
             remarks=remarks
         )
         db.session.add(new_quiz)
+        db.session.flush()
+        # A new quiz can be the best next step for students weak in this subject
+        rebuild_recommendations(users_in_subject(new_quiz.chapter.subject_id))
         db.session.commit()
         flash('Quiz added successfully!', 'success')
         return redirect(url_for('manage_quizzes', chapter_id=chapter_id))
@@ -527,7 +587,8 @@ def delete_quiz(id):
         quiz = Quiz.query.get_or_404(id)
         chapter_id = quiz.chapter_id
         
-        # First delete all scores associated with this quiz
+        # First delete all scores and recommendations associated with this quiz
+        affected_users = forget_quiz(id)
         Score.query.filter_by(quiz_id=id).delete()
         
         # Then delete all questions associated with this quiz
@@ -535,6 +596,8 @@ def delete_quiz(id):
         
         # Finally delete the quiz
         db.session.delete(quiz)
+        db.session.flush()
+        rebuild_recommendations(affected_users)
         db.session.commit()
         
         flash('Quiz deleted successfully!', 'success')
@@ -1,5 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import PasswordHasherBusy, hash_password, verify_password, needs_rehash
 import json
 from datetime import datetime
 
@@ -8,17 +8,26 @@ db = SQLAlchemy()
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
     full_name = db.Column(db.String(120), nullable=False)
     qualification = db.Column(db.String(120))
     dob = db.Column(db.Date)
     role = db.Column(db.String(20), default='user')  # 'admin' or 'user'
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not verify_password(self.password_hash, password):
+            return False
+        # Upgrade hashes made with older parameters; the caller commits the session.
+        # Best-effort: if the pool is busy, keep the old hash and retry next login.
+        if needs_rehash(self.password_hash):
+            try:
+                self.set_password(password)
+            except PasswordHasherBusy:
+                pass
+        return True
 
 class Subject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -58,6 +67,9 @@ class Question(db.Model):
         return getattr(self, f'option{self.correct_option}')
 
 class Score(db.Model):
+    # Lets the recommendation batch seek to its (timestamp, id) cursor instead of scanning
+    __table_args__ = (db.Index('ix_score_timestamp_id', 'timestamp', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), nullable=False)
@@ -79,3 +91,32 @@ class Score(db.Model):
     user = db.relationship('User', backref=db.backref('scores', lazy=True))
     quiz = db.relationship('Quiz', back_populates='scores', lazy=True)
 
+
+class ChapterMastery(db.Model):
+    # Running per-user, per-chapter totals maintained by the nightly recommendation batch
+    __table_args__ = (db.UniqueConstraint('user_id', 'chapter_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    score_sum = db.Column(db.Float, nullable=False, default=0)
+
+class RecommendationCursor(db.Model):
+    # Single row marking the newest score folded into ChapterMastery. Score ids can be
+    # reused by SQLite after deletes, so the cursor orders by (timestamp, id) instead.
+    id = db.Column(db.Integer, primary_key=True)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    last_score_id = db.Column(db.Integer, nullable=False)
+
+class Recommendation(db.Model):
+    __table_args__ = (db.Index('ix_recommendation_user_rank', 'user_id', 'rank'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    quiz_id = db.Column(db.Integer, db.ForeignKey('quiz.id'), nullable=False)
+    rank = db.Column(db.Integer, nullable=False)
+    weakness = db.Column(db.Float, nullable=False)  # 0 (mastered) to 100 (weakest)
+    computed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    quiz = db.relationship('Quiz', lazy=True)
@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+# werkzeug's hashlib-backed scrypt/pbkdf2 release the GIL, so a thread pool is
+# enough to cap how many cores password hashing can occupy at once.
+DEFAULTS = {
+    'PASSWORD_HASH_METHOD': 'scrypt:32768:8:1',
+    'PASSWORD_HASH_WORKERS': max(1, (os.cpu_count() or 2) // 2),
+    'PASSWORD_HASH_QUEUE_SIZE': 64,
+    'PASSWORD_HASH_TIMEOUT': 10,  # seconds to wait for a free slot
+}
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing queue stays full for longer than PASSWORD_HASH_TIMEOUT."""
+
+
+def _config(key):
+    if has_app_context():
+        return current_app.config.get(key, DEFAULTS[key])
+    return DEFAULTS[key]
+
+
+def _get_executor():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = _config('PASSWORD_HASH_WORKERS')
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+            _slots = threading.BoundedSemaphore(workers + _config('PASSWORD_HASH_QUEUE_SIZE'))
+        return _executor, _slots
+
+
+def _run(fn, *args):
+    executor, slots = _get_executor()
+    timeout = _config('PASSWORD_HASH_TIMEOUT')
+    if not slots.acquire(timeout=timeout):
+        raise PasswordHasherBusy('Password hashing queue is full')
+    try:
+        future = executor.submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    return future.result()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, _config('PASSWORD_HASH_METHOD'))
+
+
+def verify_password(pwhash, password):
+    return _run(check_password_hash, pwhash, password)
+
+
+def _method_prefix(method):
+    # Expands shorthand like 'scrypt' to the full 'scrypt:32768:8:1' that werkzeug
+    # stores in hashes, without running a hash on the request thread
+    name, *args = method.split(':')
+    if name == 'scrypt' and not args:
+        args = ['32768', '8', '1']
+    elif name == 'pbkdf2':
+        args = (args + [DEFAULT_PBKDF2_ITERATIONS])[:2] if args else ['sha256', DEFAULT_PBKDF2_ITERATIONS]
+    return ':'.join([name] + [str(arg) for arg in args])
+
+
+def needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != _method_prefix(_config('PASSWORD_HASH_METHOD'))
+
+
+def benchmark(seconds=5.0, method=None, workers=None):
+    """Hash continuously on `workers` threads for `seconds`.
+
+    Returns (total hashes, cores used, hashes/sec per core). Threads beyond the
+    CPU count only share cores, so the per-core rate divides by whichever is smaller.
+    """
+    method = method or _config('PASSWORD_HASH_METHOD')
+    workers = workers or _config('PASSWORD_HASH_WORKERS')
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        count = 0
+        while time.perf_counter() < deadline:
+            generate_password_hash('benchmark-password', method)
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        total = sum(pool.map(lambda _: worker(), range(workers)))
+    elapsed = time.perf_counter() - start
+    cores = min(workers, os.cpu_count() or 1)
+    return total, cores, total / elapsed / cores
@@ -0,0 +1,226 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from models import db, Score, Quiz, Chapter, ChapterMastery, Recommendation, RecommendationCursor
+
+RECOMMENDATIONS_PER_USER = 5
+# Share of a chapter's weakness that comes from the user's overall standing in its subject
+SUBJECT_WEIGHT = 0.3
+# Scores newer than this are left for the next run so a submission still being
+# committed cannot land behind the cursor
+SETTLE_TIME = timedelta(minutes=1)
+
+
+def refresh_recommendations(full=False):
+    """Fold new scores into ChapterMastery and rebuild recommendations for affected users.
+
+    Only scores after the stored (timestamp, id) cursor are aggregated, so the
+    nightly run stays proportional to the day's activity. Catalog changes are
+    handled by the routes that make them (see users_in_subject). Pass full=True
+    to rebuild from scratch. Returns the number of users updated.
+    """
+    _lock_for_write()
+    if full:
+        db.session.execute(delete(Recommendation))
+        db.session.execute(delete(ChapterMastery))
+        db.session.execute(delete(RecommendationCursor))
+    cursor = db.session.get(RecommendationCursor, 1)
+
+    new_scores = [Score.timestamp <= datetime.utcnow() - SETTLE_TIME]
+    if cursor is not None:
+        new_scores.append(_after_cursor(cursor))
+
+    # One grouped query across all users for everything submitted since the last run
+    deltas = db.session.execute(
+        select(Score.user_id, Quiz.chapter_id, func.count(Score.id), func.sum(Score.total_score))
+        .join(Quiz, Score.quiz_id == Quiz.id)
+        .where(*new_scores)
+        .group_by(Score.user_id, Quiz.chapter_id)
+    ).all()
+    newest = db.session.execute(
+        select(Score.timestamp, Score.id)
+        .where(*new_scores)
+        .order_by(Score.timestamp.desc(), Score.id.desc())
+        .limit(1)
+    ).first()
+
+    if deltas:
+        upsert = sqlite_insert(ChapterMastery)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[ChapterMastery.user_id, ChapterMastery.chapter_id],
+            set_={
+                'attempts': ChapterMastery.attempts + upsert.excluded.attempts,
+                'score_sum': ChapterMastery.score_sum + upsert.excluded.score_sum,
+            },
+        )
+        db.session.execute(upsert, [
+            {'user_id': user_id, 'chapter_id': chapter_id, 'attempts': attempts, 'score_sum': score_sum}
+            for user_id, chapter_id, attempts, score_sum in deltas
+        ])
+
+    if newest is None:
+        db.session.commit()
+        return 0
+
+    if cursor is None:
+        cursor = RecommendationCursor(id=1)
+        db.session.add(cursor)
+    cursor.last_timestamp, cursor.last_score_id = newest
+
+    # Ids come from the rows just aggregated; a subquery on the cursor would now see nothing
+    user_ids = {row[0] for row in deltas}
+    rebuild_recommendations(user_ids)
+    db.session.commit()
+    return len(user_ids)
+
+
+def discard_scores(*criteria):
+    """Subtract already-aggregated scores matching criteria from ChapterMastery.
+
+    Call before deleting the scores; returns the affected user ids so the caller
+    can rebuild their recommendations once the delete is flushed.
+    """
+    _lock_for_write()
+    cursor = db.session.get(RecommendationCursor, 1)
+    if cursor is None:
+        return set()
+
+    processed = db.session.execute(
+        select(Score.user_id, Quiz.chapter_id, func.count(Score.id), func.sum(Score.total_score))
+        .join(Quiz, Score.quiz_id == Quiz.id)
+        .where(tuple_(Score.timestamp, Score.id) <= (cursor.last_timestamp, cursor.last_score_id), *criteria)
+        .group_by(Score.user_id, Quiz.chapter_id)
+    ).all()
+    for user_id, chapter_id, attempts, score_sum in processed:
+        db.session.execute(
+            update(ChapterMastery)
+            .where(ChapterMastery.user_id == user_id, ChapterMastery.chapter_id == chapter_id)
+            .values(attempts=ChapterMastery.attempts - attempts,
+                    score_sum=ChapterMastery.score_sum - score_sum)
+        )
+    db.session.execute(delete(ChapterMastery).where(ChapterMastery.attempts <= 0))
+    return {row[0] for row in processed}
+
+
+def forget_quiz(quiz_id):
+    """Discard a quiz's scores from ChapterMastery and drop recommendations pointing at it.
+
+    Call before deleting the quiz; returns the affected user ids.
+    """
+    user_ids = discard_scores(Score.quiz_id == quiz_id)
+    user_ids.update(db.session.scalars(select(Recommendation.user_id).where(Recommendation.quiz_id == quiz_id)))
+    db.session.execute(delete(Recommendation).where(Recommendation.quiz_id == quiz_id))
+    return user_ids
+
+
+def forget_chapters(chapter_ids):
+    """Drop mastery and recommendations tied to chapters that are being deleted.
+
+    Returns the affected user ids so the caller can rebuild their recommendations.
+    """
+    quiz_ids = select(Quiz.id).where(Quiz.chapter_id.in_(chapter_ids))
+    user_ids = set(db.session.scalars(
+        select(ChapterMastery.user_id).where(ChapterMastery.chapter_id.in_(chapter_ids))
+    ))
+    user_ids.update(db.session.scalars(
+        select(Recommendation.user_id).where(Recommendation.quiz_id.in_(quiz_ids))
+    ))
+    db.session.execute(delete(Recommendation).where(Recommendation.quiz_id.in_(quiz_ids)))
+    db.session.execute(delete(ChapterMastery).where(ChapterMastery.chapter_id.in_(chapter_ids)))
+    return user_ids
+
+
+def users_in_subject(subject_id):
+    """User ids whose recommendations draw on the given subject's chapters."""
+    return set(db.session.scalars(
+        select(ChapterMastery.user_id)
+        .join(Chapter, ChapterMastery.chapter_id == Chapter.id)
+        .where(Chapter.subject_id == subject_id)
+        .distinct()
+    ))
+
+
+def rebuild_recommendations(user_ids):
+    """Replace the Recommendation rows of user_ids (a collection or subquery) from ChapterMastery."""
+    mastery = db.session.execute(
+        select(ChapterMastery.user_id, ChapterMastery.chapter_id, Chapter.subject_id,
+               ChapterMastery.attempts, ChapterMastery.score_sum)
+        .join(Chapter, ChapterMastery.chapter_id == Chapter.id)
+        .where(ChapterMastery.user_id.in_(user_ids))
+    ).all()
+    best_scores = dict(
+        ((user_id, quiz_id), best) for user_id, quiz_id, best in db.session.execute(
+            select(Score.user_id, Score.quiz_id, func.max(Score.total_score))
+            .where(Score.user_id.in_(user_ids))
+            .group_by(Score.user_id, Score.quiz_id)
+        )
+    )
+
+    chapters_by_subject = defaultdict(list)
+    for chapter_id, subject_id in db.session.execute(select(Chapter.id, Chapter.subject_id)):
+        chapters_by_subject[subject_id].append(chapter_id)
+    quizzes_by_chapter = defaultdict(list)
+    for quiz_id, chapter_id in db.session.execute(select(Quiz.id, Quiz.chapter_id)):
+        quizzes_by_chapter[chapter_id].append(quiz_id)
+
+    rows = []
+    now = datetime.utcnow()
+    for user_id, weakness in _weakness_by_user(mastery, chapters_by_subject).items():
+        candidates = []
+        for chapter_id, chapter_weakness in weakness.items():
+            if chapter_weakness <= 0:
+                continue
+            for quiz_id in quizzes_by_chapter[chapter_id]:
+                best = best_scores.get((user_id, quiz_id))
+                # Unattempted quizzes first, then the ones the user did worst on
+                candidates.append((-chapter_weakness, best is not None, best or 0, quiz_id, chapter_weakness))
+        candidates.sort()
+        for rank, (_, _, _, quiz_id, chapter_weakness) in enumerate(candidates[:RECOMMENDATIONS_PER_USER], start=1):
+            rows.append({'user_id': user_id, 'quiz_id': quiz_id, 'rank': rank,
+                         'weakness': round(chapter_weakness, 2), 'computed_at': now})
+
+    db.session.execute(delete(Recommendation).where(Recommendation.user_id.in_(user_ids)))
+    if rows:
+        db.session.execute(Recommendation.__table__.insert(), rows)
+
+
+def _after_cursor(cursor):
+    return tuple_(Score.timestamp, Score.id) > (cursor.last_timestamp, cursor.last_score_id)
+
+
+def _lock_for_write():
+    # pysqlite only opens a transaction at the first write, so reads before it see
+    # no lock. Take SQLite's write lock up front so the batch and score deletions
+    # cannot interleave between reading the cursor and updating ChapterMastery.
+    if not db.session.connection().connection.driver_connection.in_transaction:
+        db.session.execute(text('BEGIN IMMEDIATE'))
+
+
+def _weakness_by_user(mastery, chapters_by_subject):
+    """Map user_id -> {chapter_id: weakness} from aggregated ChapterMastery rows.
+
+    Weakness is 100 minus the average score, blended with the user's
+    attempt-weighted weakness across the whole subject. Chapters the user has not
+    attempted yet inherit the subject weakness so they surface as next steps.
+    """
+    chapter_weakness = defaultdict(dict)
+    subject_totals = defaultdict(lambda: [0, 0.0])
+    for user_id, chapter_id, subject_id, attempts, score_sum in mastery:
+        chapter_weakness[user_id][chapter_id] = 100 - score_sum / attempts
+        totals = subject_totals[(user_id, subject_id)]
+        totals[0] += attempts
+        totals[1] += score_sum
+
+    result = defaultdict(dict)
+    for (user_id, subject_id), (attempts, score_sum) in subject_totals.items():
+        subject_weakness = 100 - score_sum / attempts
+        for chapter_id in chapters_by_subject[subject_id]:
+            own = chapter_weakness[user_id].get(chapter_id)
+            if own is None:
+                result[user_id][chapter_id] = subject_weakness
+            else:
+                result[user_id][chapter_id] = (1 - SUBJECT_WEIGHT) * own + SUBJECT_WEIGHT * subject_weakness
+    return result